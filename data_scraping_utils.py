@@ -1,23 +1,118 @@
 """Utility functions used to scrape head to head historical seed matchup data."""
+import json
+import pickle
 import re
 import requests
-from itertools import chain
-from typing import Dict, List
+import time
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
 
 import bs4
 import numpy as np
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 NCAA_WIKI_URL = (
     "https://en.wikipedia.org/wiki/NCAA_Division_I_men%27s_basketball_tournament"
 )
+#  wikipedia throttles the default python user agent, so identify the scraper explicitly
+USER_AGENT = "run_your_pool_optimization (https://github.com/asoane34/run_your_pool_optimization)"
+#  scraped results are stored next to this module and reused for as long as the page hasn't changed
+CACHE_DIRECTORY = Path(__file__).parent / "cache"
+#  bump whenever the parsing changes what is scraped from the page, so results cached by older code are ignored
+CACHE_FORMAT_VERSION = "1"
+#  if the page doesn't report a version, cached results are reused for up to a week
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+#  patterns used when parsing the page, compiled once since they are applied to every row / line item
+_SEED_NUM_RE = re.compile(r"\d{1,2}")
+_NO_SEED_RE = re.compile(r"No\.\s\d{1,2}")
+_DEC_RE = re.compile(r"\.\d+")
+_PCT_RE = re.compile(r"\d*\.\d+")
+_ROUND64_MARKER = re.compile(r"The\sNo\.")
+#  shared session so every request reuses pooled keep-alive connections and retries transient failures
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": USER_AGENT})
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_maxsize=10, max_retries=Retry(total=3, backoff_factor=0.3)),
+)
+
+
+def get_page_version(url: str) -> Optional[str]:
+    """Get the ETag (or Last-Modified) header of a page without downloading it."""
+    try:
+        response = _SESSION.head(url, allow_redirects=True, timeout=10)
+    except requests.RequestException:
+        return None
+    return response.headers.get("ETag") or response.headers.get("Last-Modified")
+
+
+def cache_scraped_result(url: str, cache_name: str) -> Callable:
+    """
+    Memoize the result of a scraping function on disk, keyed by the version of the scraped page.
 
+    The cached result is reused as long as the ETag / Last-Modified header of the page matches the one
+    stored alongside it. If the page version can't be determined, the cached result is reused until it is
+    older than `CACHE_TTL_SECONDS`. Results cached with a different `CACHE_FORMAT_VERSION` are never reused.
 
+    Parameters
+    ----------
+    url : str
+        url of the page the scraping function parses
+    cache_name : str
+        file name (without extension) of the cached result within `CACHE_DIRECTORY`
+
+    Returns
+    -------
+    Callable
+        decorator for a scraping function that takes no arguments
+
+    """
+
+    def decorator(scrape_function: Callable) -> Callable:
+        @wraps(scrape_function)
+        def wrapper():
+            result_path = CACHE_DIRECTORY / f"{cache_name}.pkl"
+            metadata_path = CACHE_DIRECTORY / f"{cache_name}.json"
+            page_version = get_page_version(url)
+            if result_path.exists() and metadata_path.exists():
+                metadata = json.loads(metadata_path.read_text())
+                if metadata.get("format_version") != CACHE_FORMAT_VERSION:
+                    is_cache_valid = False
+                elif page_version is not None:
+                    is_cache_valid = page_version == metadata["page_version"]
+                else:
+                    is_cache_valid = (
+                        time.time() - metadata["cached_at"] < CACHE_TTL_SECONDS
+                    )
+                if is_cache_valid:
+                    with open(result_path, "rb") as f:
+                        return pickle.load(f)
+            result = scrape_function()
+            CACHE_DIRECTORY.mkdir(parents=True, exist_ok=True)
+            with open(result_path, "wb") as f:
+                pickle.dump(result, f)
+            metadata = {
+                "format_version": CACHE_FORMAT_VERSION,
+                "page_version": page_version,
+                "cached_at": time.time(),
+            }
+            metadata_path.write_text(json.dumps(metadata))
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+@cache_scraped_result(url=NCAA_WIKI_URL, cache_name="ncaa_win_probabilities")
 def scrape_winning_percentage_dict_from_wikipedia() -> Dict[int, Dict[int, float]]:
     """Scrape single region head to head win probability for NCAA March Madness from wikipedia."""
-    page_data = requests.get(NCAA_WIKI_URL)
-    page_soup = BeautifulSoup(page_data.content, "html.parser")
+    page_data = _SESSION.get(NCAA_WIKI_URL, timeout=10)
+    page_soup = BeautifulSoup(page_data.content, "lxml")
     # start by creating our base object and parse the round of 64 results, which appear in a different
     # format than the rest of the results
     base_winning_percentage_dict = parse_round_of_64_results(page_soup=page_soup)
@@ -30,7 +125,7 @@ def scrape_winning_percentage_dict_from_wikipedia() -> Dict[int, Dict[int, float
         )
         # there could be multiple seeds in each dictionary
         for seed, prob_dict in seed_win_pctage_dict.items():
-            if seed in base_winning_percentage_dict.keys():
+            if seed in base_winning_percentage_dict:
                 base_winning_percentage_dict[seed].update(prob_dict)
             else:
                 base_winning_percentage_dict[seed] = prob_dict
@@ -81,7 +176,7 @@ def parse_round_of_64_results(
             first_line = all_lines[0].contents[0]
             if isinstance(first_line, str):
                 # if it's a string, we can check for our match group
-                if re.match(r"The\sNo\.", first_line):
+                if _ROUND64_MARKER.match(first_line):
                     seeding_lines = all_lines
                     break
     # now we can parse the results easily
@@ -91,11 +186,11 @@ def parse_round_of_64_results(
         # there's a two step regex here since there are other potential number match groups
         # in the sentence text we need to avoid
         seed_1, seed_2 = [
-            int(re.search("\d+", match).group())
-            for match in re.findall(r"No\.\s\d{1,2}", line_contents)
+            int(_SEED_NUM_RE.search(match).group())
+            for match in _NO_SEED_RE.findall(line_contents)
         ]
         # now get the winning percentage
-        winning_percentage = float(re.search(r"\.\d+", line_contents).group())
+        winning_percentage = float(_DEC_RE.search(line_contents).group())
         base_winning_percentage_dict[seed_1] = {seed_2: winning_percentage}
     return base_winning_percentage_dict
 
@@ -125,30 +220,20 @@ def parse_wikipedia_bracket_matchup_table(
     # the first row is the header row, the last row is the "Totals" row, so the percentages themselves are in the
     # middle N rows
     content_rows = all_table_rows[1:-1]
-    # identify the header seeds
-    header_seeds = re.findall(
-        "\d{1,2}",
-        "_".join(
-            chain.from_iterable(
-                [header.contents for header in header_row.find_all("th")[1:-1]]
-            )
-        ),
+    # identify the header seeds from the text of the header cells
+    header_text = "_".join(
+        header.get_text() for header in header_row.find_all("th")[1:-1]
     )
     # convert to integer type, it'll work smoother in the optimization algorithm
-    header_seeds = [int(seed) for seed in header_seeds]
+    header_seeds = [int(seed) for seed in _SEED_NUM_RE.findall(header_text)]
     # create dictionary to store winning percentages
     winning_percentage_dict = {}
     # iterate over all rows with content
     for row in content_rows:
         # identify the seed within each row
-        seed = int(re.search("\d{1,2}", row.find("th").contents[0]).group())
+        seed = int(_SEED_NUM_RE.search(row.find("th").get_text()).group())
         # extract the winning percentage between this seed combination
-        all_tags = [
-            re.search("\d*\.\d+", s)
-            for s in (
-                chain.from_iterable([tag.contents for tag in row.find_all("td")][:-1])
-            )
-        ]
+        all_tags = [_PCT_RE.search(tag.get_text()) for tag in row.find_all("td")[:-1]]
         # it's possible that two seed combinations have never played, but the optimization will probably
         # encounter these, so in these cases we'll assign an arbitrary value of 0.50 since there's no way
         # of knowing what the actual historical win percentage would be - these are very low probability
@@ -1,11 +1,12 @@
 """Utility functions used in running optimization."""
+import multiprocessing
+import os
 import warnings
-from copy import deepcopy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
-import pandas as pd
+from numba import njit, prange
 from skopt import gp_minimize
 
 #  dictionary outlining potential seed paths for each of the top 8 seeds
@@ -19,7 +20,16 @@ SEED_PATH_DICTIONARY = {
     7: [10, (2, 15), (3, 6, 11, 14), (1, 4, 5, 8, 9, 12, 13, 16)],
     8: [9, (1, 16), (4, 5, 12, 13), (2, 3, 6, 7, 10, 11, 14, 15)],
 }
-SINGLE_REGION_SEARCH_SPACE = list(np.arange(1, 17))
+SINGLE_REGION_SEARCH_SPACE = tuple(range(1, 17))
+#  array form of the single region search space, used directly when clipping inputs
+_SEARCH_SPACE_ARR = np.arange(1, 17, dtype=np.int8)
+#  initial seed positions in standard bracket order - the teams in slots i and i + 1 always play each other
+REGION_SLOT_ORDER = np.array(
+    [1, 16, 8, 9, 5, 12, 4, 13, 6, 11, 3, 14, 7, 10, 2, 15], dtype=np.int8
+)
+#  generator shared by single bracket simulations that aren't given one, creating a fresh one per bracket is
+#  comparatively slow
+_RNG = np.random.default_rng()
 
 
 def calculate_total_points_for_seed_combination(
@@ -35,32 +45,285 @@ def calculate_total_points_for_seed_combination(
     )
     # run the optimization a thousand times - this allows create an expected value for points for this seed
     # combination so that we can ignore anomalous runs
-    region_results = []
-    for _ in range(n_iterations):
-        region = RegionBracket(
-            seed_path_dictionary=SEED_PATH_DICTIONARY,
-            win_probability_dictionary=win_probability_dictionary,
-        )
-        region.simulate_region_tournament()
-        region_results.append(region.points_by_seed)
-    # create output dataframe and filter to desired seeds
-    region_result_df = pd.DataFrame(region_results)[clipped_seeds]
-    # take sum across first, axis, and then take the mean of this summed column
-    average_total_point_value = region_result_df.sum(axis=1).mean()
+    region_points = simulate_region_tournament_batch(
+        win_prob_matrix=build_win_prob_matrix(win_probability_dictionary),
+        n_paths=n_iterations,
+    )
+    # filter to desired seeds, take sum across each simulated region, and then take the mean of these sums
+    average_total_point_value = region_points[:, clipped_seeds].sum(axis=1).mean()
     return average_total_point_value
 
 
+def build_win_prob_matrix(
+    win_probability_dictionary: Dict[int, Dict[int, float]],
+) -> np.ndarray:
+    """
+    Build dense matrix where entry [i, j] is the probability that seed i beats seed j.
+
+    Each matchup only needs to be recorded from the point of view of one of the seeds, the other side
+    of the matrix is filled in as 1 - p. All matchups are validated here so that simulations can index the
+    matrix without checking for missing probabilities.
+
+    Parameters
+    ----------
+    win_probability_dictionary : Dict[int, Dict[int, float]]
+        dictionary keyed by integer seed value containing integer seed of opponent and the corresponding
+        win percentage
+
+    Returns
+    -------
+    np.ndarray
+        17x17 win probability matrix, row and column 0 are unused so seeds can index the matrix directly
+
+    Raises
+    ------
+    ValueError
+        if a matchup between two seeds is missing, or only has a negative placeholder probability
+
+    """
+    win_prob_matrix = np.full((17, 17), 0.5, dtype=np.float32)
+    is_recorded = np.zeros((17, 17), dtype=bool)
+    for seed, opponent_win_prob_dict in win_probability_dictionary.items():
+        for opponent, win_probability in opponent_win_prob_dict.items():
+            # matchups that have never been played are scraped with a negative placeholder probability
+            if not 0.0 <= win_probability <= 1.0:
+                raise ValueError(f"Matchup probability is missing: {seed, opponent}")
+            win_prob_matrix[seed, opponent] = win_probability
+            is_recorded[seed, opponent] = True
+    # fill in the mirror side of each matchup without overwriting any recorded probabilities
+    mirror_only = is_recorded.T & ~is_recorded
+    win_prob_matrix[mirror_only] = 1.0 - win_prob_matrix.T[mirror_only]
+    # every pair of different seeds can meet in a region, so each needs a probability from one side or the other
+    is_missing = ~(is_recorded | is_recorded.T)[1:, 1:]
+    np.fill_diagonal(is_missing, False)
+    if is_missing.any():
+        seed, opponent = (np.argwhere(is_missing)[0] + 1).tolist()
+        raise ValueError(f"Matchup probability is missing: {seed, opponent}")
+    return win_prob_matrix
+
+
+def simulate_region_tournament_batch(
+    win_prob_matrix: np.ndarray,
+    n_paths: int,
+    rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    """
+    Simulate all 4 rounds of the region for many brackets at once.
+
+    Parameters
+    ----------
+    win_prob_matrix : np.ndarray
+        17x17 matrix of win probabilities from `build_win_prob_matrix`
+    n_paths : int
+        number of region brackets to simulate
+    rng : Optional[np.random.Generator]
+        random generator to draw game outcomes from, a fresh generator is used if not provided
+
+    Returns
+    -------
+    np.ndarray
+        array of shape (n_paths, 17) containing the points scored by each seed in each simulated bracket,
+        column 0 is unused
+
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    points = np.zeros((n_paths, 17), dtype=np.int32)
+    path_idx = np.arange(n_paths)[:, None]
+    active_seeds = np.broadcast_to(REGION_SLOT_ORDER, (n_paths, 16)).copy()
+    for _ in range(4):
+        # adjacent slots make up the matchups of the round, winners keep the bracket order for the next round
+        matchups = active_seeds.reshape(n_paths, active_seeds.shape[1] // 2, 2)
+        # draw every game of the round across all brackets in one call
+        win_probabilities = win_prob_matrix[matchups[..., 0], matchups[..., 1]]
+        outcomes = rng.random(win_probabilities.shape) < win_probabilities
+        winners = np.where(outcomes, matchups[..., 0], matchups[..., 1])
+        np.add.at(points, (path_idx, winners), winners)
+        active_seeds = winners
+    return points
+
+
+def simulate_many(
+    win_prob_matrix: np.ndarray,
+    n_trials: int,
+    n_jobs: int = -1,
+    batch_size: int = 100_000,
+) -> np.ndarray:
+    """
+    Simulate many region brackets split across worker processes and total the points scored by each seed.
+
+    Parameters
+    ----------
+    win_prob_matrix : np.ndarray
+        17x17 matrix of win probabilities from `build_win_prob_matrix`
+    n_trials : int
+        total number of region brackets to simulate
+    n_jobs : int
+        number of worker processes - negative values count back from the number of cores as in joblib, so -1
+        uses every core and -2 every core but one
+    batch_size : int
+        maximum number of brackets each worker simulates at once, which bounds its memory use - at most one
+        worker is started per batch
+
+    Returns
+    -------
+    np.ndarray
+        array of length 17 with the total points scored by each seed across all trials, index 0 is unused -
+        divide by `n_trials` for the expected points by seed
+
+    Raises
+    ------
+    ValueError
+        if `n_jobs` is 0
+
+    """
+    if n_jobs == 0:
+        raise ValueError("n_jobs must be a positive or negative integer, not 0")
+    if n_jobs < 0:
+        n_jobs = (os.cpu_count() or 1) + 1 + n_jobs
+    # spawning a worker costs far more than simulating a batch, so never use more workers than there are
+    # batches - runs that fit in a single batch stay in this process
+    n_batches = -(-n_trials // batch_size)
+    n_jobs = max(1, min(n_jobs, n_batches))
+    # every worker gets its own independent random stream
+    worker_seeds = np.random.SeedSequence().spawn(n_jobs)
+    # split the trials as evenly as possible, the first n_trials % n_jobs workers take one extra
+    trials_per_job = [
+        n_trials // n_jobs + (job < n_trials % n_jobs) for job in range(n_jobs)
+    ]
+    worker_args = [
+        (win_prob_matrix, job_trials, seed, batch_size)
+        for job_trials, seed in zip(trials_per_job, worker_seeds)
+    ]
+    if n_jobs == 1:
+        return _total_points_for_trials(*worker_args[0])
+    # workers are spawned rather than forked - forking after the numba parallel kernel has started its
+    # threading layer leaves the interpreter unable to exit
+    with multiprocessing.get_context("spawn").Pool(processes=n_jobs) as pool:
+        worker_totals = pool.starmap(_total_points_for_trials, worker_args)
+    return np.sum(worker_totals, axis=0)
+
+
+def _total_points_for_trials(
+    win_prob_matrix: np.ndarray,
+    n_trials: int,
+    seed: np.random.SeedSequence,
+    batch_size: int,
+) -> np.ndarray:
+    """Total the points scored by each seed over `n_trials` brackets, simulated in batches."""
+    rng = np.random.default_rng(seed)
+    total_points = np.zeros(17, dtype=np.int64)
+    for batch_start in range(0, n_trials, batch_size):
+        batch_points = simulate_region_tournament_batch(
+            win_prob_matrix=win_prob_matrix,
+            n_paths=min(batch_size, n_trials - batch_start),
+            rng=rng,
+        )
+        total_points += batch_points.sum(axis=0)
+    return total_points
+
+
+@njit(cache=True)
+def simulate_one(
+    slot_order: np.ndarray,
+    win_prob_matrix: np.ndarray,
+    rand_uniforms: np.ndarray,
+    points_out: np.ndarray,
+) -> None:
+    """
+    Simulate a single region bracket, adding the points scored by each seed to `points_out`.
+
+    Parameters
+    ----------
+    slot_order : np.ndarray
+        initial seed positions in bracket order, i.e. `REGION_SLOT_ORDER`
+    win_prob_matrix : np.ndarray
+        17x17 matrix of win probabilities from `build_win_prob_matrix`
+    rand_uniforms : np.ndarray
+        15 uniform random draws, one per game in the region
+    points_out : np.ndarray
+        preallocated array of length 17 that the points scored by each seed are added to
+
+    """
+    active_seeds = slot_order.copy()
+    game_idx = 0
+    n_active = active_seeds.shape[0]
+    while n_active > 1:
+        for slot in range(0, n_active, 2):
+            left_seed = active_seeds[slot]
+            right_seed = active_seeds[slot + 1]
+            if rand_uniforms[game_idx] < win_prob_matrix[left_seed, right_seed]:
+                winning_seed = left_seed
+            else:
+                winning_seed = right_seed
+            # winners are written back in bracket order, so the next round is again adjacent slots
+            active_seeds[slot // 2] = winning_seed
+            points_out[winning_seed] += winning_seed
+            game_idx += 1
+        n_active //= 2
+
+
+@njit(cache=True, parallel=True)
+def simulate_region_tournaments_parallel(
+    slot_order: np.ndarray,
+    win_prob_matrix: np.ndarray,
+    rand_uniforms: np.ndarray,
+    points_out: np.ndarray,
+) -> None:
+    """
+    Simulate many region brackets across all cores with `simulate_one`.
+
+    Parameters
+    ----------
+    slot_order : np.ndarray
+        initial seed positions in bracket order, i.e. `REGION_SLOT_ORDER`
+    win_prob_matrix : np.ndarray
+        17x17 matrix of win probabilities from `build_win_prob_matrix`
+    rand_uniforms : np.ndarray
+        array of shape (N, 15) with uniform random draws for every game of every bracket
+    points_out : np.ndarray
+        preallocated array of shape (N, 17) that the points scored by each seed in each bracket are added to
+
+    """
+    for path in prange(rand_uniforms.shape[0]):
+        simulate_one(slot_order, win_prob_matrix, rand_uniforms[path], points_out[path])
+
+
 @dataclass
 class RegionBracket:
+    # kept for compatibility - the bracket order itself comes from REGION_SLOT_ORDER
     seed_path_dictionary: Dict[int, List[Union[int, Tuple[int]]]]
     win_probability_dictionary: Dict[int, Dict[int, float]]
+    # can be provided when simulating many brackets so the matrix is only built once
+    win_prob_matrix: Optional[np.ndarray] = field(
+        default=None, compare=False, repr=False
+    )
+    # random generator to draw game outcomes from, pass a seeded generator to reproduce a simulation
+    rng: Optional[np.random.Generator] = field(default=None, compare=False, repr=False)
 
     def __post_init__(self) -> None:
         """Initialize bracket for single region."""
-        # dictionary to store the points scored by each seed
-        self.points_by_seed = {n + 1: 0 for n in range(16)}
-        # the matchup state will change after each potential matchup
-        self.current_matchup_state = deepcopy(self.seed_path_dictionary)
+        # array to store the points scored by each seed, index 0 is unused so seeds index it directly
+        self.points = np.zeros(17, dtype=np.int32)
+        # the bracket is a flat array of slots - after each round the winner of a matchup is written to the
+        # leftmost slot of that matchup, so the teams still alive are always stride // 2 slots apart
+        self.bracket_state = REGION_SLOT_ORDER.copy()
+        self.stride = 2
+        # draw the randomness for all 15 games of the region up front, one uniform per game
+        if self.rng is None:
+            self.rng = _RNG
+        self.game_uniforms = self.rng.random(15)
+        self.game_index = 0
+        # dense lookup of win probabilities so each simulated game is a single array index
+        if self.win_prob_matrix is None:
+            self.win_prob_matrix = build_win_prob_matrix(
+                self.win_probability_dictionary
+            )
+
+    @property
+    def points_by_seed(self) -> Dict[int, int]:
+        """Points scored by each seed keyed by seed."""
+        return dict(zip(range(1, 17), self.points[1:].tolist()))
 
     def simulate_region_tournament(self) -> None:
         """Simulate all 4 rounds of the region."""
@@ -69,64 +332,28 @@ class RegionBracket:
 
     def simulate_round_and_update_current_state(self) -> None:
         """Simulate a single round of the tournament based on the current state."""
-        # iterate over the current state and create opponents - the visited data structure
-        # will allow us not duplicate simulations in matchups after the first round, where
-        # both teams in a matchup will appear in the current state
-        updated_matchup_state, visited = {}, set()
-        for seed, matchup_path in self.current_matchup_state.items():
-            if seed in visited:
-                continue
-            next_opponent = matchup_path.pop(0)
-            if isinstance(next_opponent, tuple):
-                # iterate over all elements of tuple until a match is found
-                for possible_opponent in next_opponent:
-                    if possible_opponent in self.current_matchup_state.keys():
-                        current_opponent = possible_opponent
-                        # in this case, we need to add the opponent to the visited data structure
-                        visited.add(current_opponent)
-                        break
-            else:
-                # this is only the case for the first round of the tourney, no need to do anything here
-                current_opponent = next_opponent
-            # in this case, we just need to simulate the matchup and record the winner
-            win_probability = self.extract_win_probability_by_seed(
-                seed,
-                current_opponent,
-            )
-            # draw random binomial sample to simulate game play
-            game_outcome = np.random.binomial(n=1, p=win_probability)
-            # set which team was the winning seed
-            winning_seed = seed if game_outcome else current_opponent
-            # update data structures
-            self.points_by_seed[winning_seed] += winning_seed
-            updated_matchup_state[winning_seed] = matchup_path
-        # at the end of our run, we overwrite the current matchup state with the new updated state
-        self.current_matchup_state = updated_matchup_state
+        # each matchup of the round is a team at the start of a stride against the team halfway along it
+        left_seeds = self.bracket_state[0 :: self.stride]
+        right_seeds = self.bracket_state[self.stride // 2 :: self.stride]
+        n_games = left_seeds.size
+        # compare the next pre-drawn uniforms to the win probabilities to simulate game play
+        win_probabilities = self.win_prob_matrix[left_seeds, right_seeds]
+        game_outcomes = (
+            self.game_uniforms[self.game_index : self.game_index + n_games]
+            < win_probabilities
+        )
+        winning_seeds = np.where(game_outcomes, left_seeds, right_seeds)
+        # update data structures - each seed wins at most once per round, so there are no repeated indices
+        self.points[winning_seeds] += winning_seeds
+        self.bracket_state[0 :: self.stride] = winning_seeds
+        self.game_index += n_games
+        self.stride *= 2
 
     def extract_win_probability_by_seed(
         self, current_seed: int, matchup_opponent: int
     ) -> float:
-        """Extract the win probability from win probability dictionary."""
-        # from the ordering of the seeds, we can't be sure where the win probability is stored in the dictionary
-        seed_win_prob_dict = self.win_probability_dictionary.get(current_seed)
-        if seed_win_prob_dict:
-            matchup_probability = seed_win_prob_dict.get(matchup_opponent)
-        # it's possible this is not found, in which case it's in the other dictionary
-        if not seed_win_prob_dict or matchup_probability is None:
-            # now check the other seed
-            seed_win_prob_dict = self.win_probability_dictionary.get(matchup_opponent)
-            if not seed_win_prob_dict:
-                raise ValueError(
-                    f"Matchup probability is missing: {current_seed, matchup_opponent}"
-                )
-            # in this case, the win probability is 1-the opponent's probability
-            matchup_probability = seed_win_prob_dict.get(current_seed)
-            if matchup_probability is None:
-                raise ValueError(
-                    f"Matchup probability is missing: {current_seed, matchup_opponent}"
-                )
-            matchup_probability = 1.0 - matchup_probability
-        return matchup_probability
+        """Extract the win probability from win probability matrix."""
+        return float(self.win_prob_matrix[current_seed, matchup_opponent])
 
 
 def clip_continuous_inputs_to_discrete_search_space(
@@ -135,18 +362,40 @@ def clip_continuous_inputs_to_discrete_search_space(
     replace: bool = False,
 ) -> List[int]:
     """Clip array of floating point inputs to discrete search space."""
+    # the search space is kept sorted so the nearest member of each input can be found with a binary search -
+    # the default search space array is already sorted and is never modified, so it can be used as is
     if discrete_search_space is None:
-        discrete_search_space = SINGLE_REGION_SEARCH_SPACE
+        search_space_arr = _SEARCH_SPACE_ARR
+    else:
+        search_space_arr = np.sort(discrete_search_space)
+    input_arr = np.asarray(continuous_input_arr, dtype=float)
+    if replace:
+        # every input is free to take its closest member of the search space
+        return _find_nearest_in_sorted(search_space_arr, input_arr).tolist()
+    # if replacing is not allowed (i.e. we are only searching in one region where each seed can only exist once)
+    # assign inputs in order, removing each member of the search space once it has been taken
+    if input_arr.size > search_space_arr.size:
+        raise ValueError(
+            "Cannot clip more inputs than members of the search space without replacement"
+        )
     output_values = []
-    # create array of discrete search space to use in determining position
-    search_space_arr = np.array(discrete_search_space)
-    # iterate over input
-    for value in continuous_input_arr:
-        # determine the closest member of the search space
-        nearest_neighbor_idx = np.argmin(abs(search_space_arr - value))
-        output_values.append(search_space_arr[nearest_neighbor_idx])
-        # if replacing is not allowed (i.e. we are only searching in one region where each seed can only exist once)
-        # remove the index
-        if not replace:
-            search_space_arr = np.delete(search_space_arr, nearest_neighbor_idx)
+    for value in input_arr:
+        nearest_neighbor = _find_nearest_in_sorted(search_space_arr, value).item()
+        output_values.append(nearest_neighbor)
+        search_space_arr = search_space_arr[search_space_arr != nearest_neighbor]
     return output_values
+
+
+def _find_nearest_in_sorted(
+    sorted_arr: np.ndarray, values: Union[float, np.ndarray]
+) -> np.ndarray:
+    """Find the nearest member of a sorted array for each value, ties go to the smaller member."""
+    insertion_idx = np.searchsorted(sorted_arr, values)
+    # the nearest member is either side of the insertion point, clamped to the ends of the array
+    lower_neighbor = sorted_arr[np.maximum(insertion_idx - 1, 0)]
+    upper_neighbor = sorted_arr[np.minimum(insertion_idx, sorted_arr.size - 1)]
+    return np.where(
+        np.abs(values - lower_neighbor) <= np.abs(values - upper_neighbor),
+        lower_neighbor,
+        upper_neighbor,
+    )